@@ -69,7 +69,7 @@ async def recreate_database():
                 user_input TEXT NOT NULL,
                 assistant_response TEXT NOT NULL,
                 created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
-                sequence_number INTEGER NOT NULL
+                sequence_number BIGSERIAL
             )
         """)
         print("   ✓ Created text_history table")
@@ -80,6 +80,7 @@ async def recreate_database():
         indexes = [
             ("idx_threads_user", "CREATE INDEX idx_threads_user ON threads(user_id, last_activity DESC)"),
             ("idx_api_history_thread_expires", "CREATE INDEX idx_api_history_thread_expires ON api_history(thread_id, expires_at DESC)"),  
+            ("idx_api_history_thread_created", "CREATE INDEX idx_api_history_thread_created ON api_history(thread_id, created_at DESC)"),
             ("idx_text_history_thread_seq", "CREATE INDEX idx_text_history_thread_seq ON text_history(thread_id, sequence_number)")
         ]
         
@@ -1,9 +1,12 @@
 import asyncio
+import logging
 import os
+import time
+import uuid
 import dotenv
-import json
+import orjson
 from datetime import datetime, timedelta, timezone
-from typing import Any, Optional, List, Dict, AsyncGenerator
+from typing import Any, Optional, List, Dict, Tuple, AsyncGenerator
 
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import StreamingResponse
@@ -18,6 +21,14 @@ from openai_tools import get_all_tools, get_tools_by_type, get_safe_tools
 dotenv.load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+logging.basicConfig(
+    level=LOG_LEVEL,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
 if not OPENAI_API_KEY:
     print("Warning: OPENAI_API_KEY not found in environment variables.")
 
@@ -41,8 +52,30 @@ class AgentCustomContext(BaseModel):
     current_thread_id: Optional[str] = None
     session_start_time: Optional[str] = None
 
+# --- SSE Helpers ---
+def sse_event(payload: Dict[str, Any]) -> bytes:
+    """Encode a payload as a single Server-Sent Events data frame"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+# Deltas are coalesced into one SSE frame until either limit is reached
+STREAM_FRAME_MIN_CHARS = 64
+STREAM_FRAME_MAX_DELAY = 0.032  # seconds
+
+# Stream event and item types handled by generate_stream
+RAW_RESPONSE_EVENT = "raw_response_event"
+RUN_ITEM_STREAM_EVENT = "run_item_stream_event"
+OUTPUT_TEXT_DELTA = "response.output_text.delta"
+MESSAGE_OUTPUT_ITEM = "message_output_item"
+
 # --- History Management Constants ---
 EXPIRY_DAYS = 30
+HISTORY_MODE_THREAD_TYPES = {"api": "api", "local_text": "text"}  # Anything else is a temp thread
+PRUNE_INTERVAL_SECONDS = 3600  # How often expired API history entries are deleted
+
+def new_thread_id(history_mode: str) -> Tuple[str, str]:
+    """Generate a collision-safe thread ID and its thread type for a history mode"""
+    thread_type = HISTORY_MODE_THREAD_TYPES.get(history_mode, "temp")
+    return f"{thread_type}_thread_{uuid.uuid4().hex}", thread_type
 
 # Database-backed history management functions
 async def add_response_to_api_thread_history(thread_id: str, response_id: Optional[str]) -> None:
@@ -61,39 +94,213 @@ async def load_local_text_thread_history(thread_id: str) -> str:
     await ensure_db_initialized()
     return await db_manager.get_text_history(thread_id)
 
+def build_text_prompt(history: str, user_input: str) -> str:
+    """Append the new user turn to a formatted text history in a single copy"""
+    # Stored history already ends with a newline, so one more gives the blank line between turns
+    if history:
+        return f"{history}\nUser: {user_input}\nAssistant:"
+    return f"User: {user_input}\nAssistant:"
+
 async def append_to_local_text_thread_history(thread_id: str, user_input: str, assistant_response: str) -> None:
     await ensure_db_initialized()
     await db_manager.add_text_history_entry(thread_id, user_input, assistant_response)
 
+history_write_tasks: set = set()
+
+def _history_write_done(task: asyncio.Task) -> None:
+    history_write_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"⚠️ [AGENT-API] History write failed: {task.exception()}")
+
+def start_history_write(coro) -> asyncio.Task:
+    """Run a history write as its own task so a client disconnect can't cancel it; shutdown waits for it"""
+    task = asyncio.create_task(coro)
+    history_write_tasks.add(task)
+    task.add_done_callback(_history_write_done)
+    return task
+
+async def prune_expired_history_loop() -> None:
+    """Periodically delete expired API history so request-time lookups stay small"""
+    while True:
+        try:
+            removed = await db_manager.prune_expired_api_history()
+            if removed:
+                print(f"🧹 [AGENT-API] Pruned {removed} expired API history entries")
+        except Exception as e:
+            print(f"⚠️ [AGENT-API] API history pruning failed: {e}")
+        await asyncio.sleep(PRUNE_INTERVAL_SECONDS)
+
 # --- Agent Hooks (Copied from main.py) ---
 class CustomAgentHooks(AgentHooks):
+    """Logs agent lifecycle events at DEBUG level; a single instance is shared across requests"""
     def __init__(self, display_name: str):
         self.event_counter = 0
         self.display_name = display_name
 
     async def on_start(self, context: Any, agent: Agent) -> None:
         self.event_counter += 1
-        print(f"### (API-{self.display_name}) {self.event_counter}: Agent {agent.name} starting run...")
+        logger.debug(f"### (API-{self.display_name}) {self.event_counter}: Agent {agent.name} starting run...")
 
     async def on_end(self, context: Any, agent: Agent, output: Any) -> None:
         self.event_counter += 1
-        print(f"### (API-{self.display_name}) {self.event_counter}: Agent {agent.name} finished run.")
+        logger.debug(f"### (API-{self.display_name}) {self.event_counter}: Agent {agent.name} finished run.")
 
     async def on_tool_start(self, context: Any, agent: Agent, tool: Tool) -> None:
         self.event_counter += 1
         tool_name = getattr(tool, 'name', 'Unknown Tool')
-        print(f"### (API-{self.display_name}) {self.event_counter}: Agent {agent.name} starting tool: {tool_name}")
+        logger.debug(f"### (API-{self.display_name}) {self.event_counter}: Agent {agent.name} starting tool: {tool_name}")
 
     async def on_tool_end(self, context: Any, agent: Agent, tool: Tool, result: str) -> None:
         self.event_counter += 1
         tool_name = getattr(tool, 'name', 'Unknown Tool')
-        print(f"### (API-{self.display_name}) {self.event_counter}: Agent {agent.name} finished tool: {tool_name} with result: {result}")
+        logger.debug(f"### (API-{self.display_name}) {self.event_counter}: Agent {agent.name} finished tool: {tool_name} with result: {result}")
+
+agent_hooks = CustomAgentHooks(display_name="FastAPI_Agent")
+
+# --- Agent Cache ---
+AGENT_CACHE_SIZE = 32  # Distinct (agent name, tool selection) combinations kept built
+agent_cache: Dict[Tuple[str, Optional[Tuple[str, ...]]], Tuple[List[MCPServerStreamableHttp], Agent]] = {}
+
+def get_agent(name: str, request: InvokeRequest, mcp_servers: List[MCPServerStreamableHttp]) -> Agent:
+    """Return a shared Agent for the request's tool selection, rebuilt when the MCP connection changes"""
+    tools_key = tuple(request.tool_types or ()) if request.enable_tools else None
+    key = (name, tools_key)
+    cached = agent_cache.get(key)
+    if cached and cached[0] == mcp_servers:
+        return cached[1]
+
+    openai_tools = []
+    if request.enable_tools:
+        if request.tool_types:
+            openai_tools = get_tools_by_type(request.tool_types)
+        else:
+            openai_tools = get_all_tools()  # Use all tools by default
+
+    agent = Agent[AgentCustomContext](
+        name=name,
+        model="gpt-4.1", # TODO: Make model configurable
+        instructions=main_system_prompt,
+        hooks=agent_hooks,
+        tools=openai_tools,  # Add OpenAI tools
+        mcp_servers=mcp_servers  # Shared MCP connection (empty if unavailable)
+    )
+
+    if key not in agent_cache and len(agent_cache) >= AGENT_CACHE_SIZE:
+        agent_cache.pop(next(iter(agent_cache)))
+    agent_cache[key] = (mcp_servers, agent)
+    return agent
+
+# --- Shared MCP Connection ---
+MCP_RECONNECT_COOLDOWN = 30  # Seconds to wait after a failed connect before trying again
+MCP_PING_TIMEOUT = 5  # Seconds a health-check ping may take before the session counts as dead
+MCP_IDLE_PING_AFTER = 15  # Ping a session idle this long before handing it out (tool lists are cached, so an MCP restart is otherwise unnoticed)
+
+class SharedMCPConnection:
+    """Long-lived MCP client connection reused across requests.
+
+    The connection is opened and closed inside a dedicated task so its
+    underlying task group is always entered and exited from the same task.
+    """
+    def __init__(self, url: str):
+        self.url = url
+        self.server: Optional[MCPServerStreamableHttp] = None
+        self._task: Optional[asyncio.Task] = None
+        self._ready = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._failed_at: Optional[float] = None  # Monotonic time of the last failed connect
+        self._last_used = 0.0  # Monotonic time the session was last handed out or checked
+
+    async def _run(self) -> None:
+        server = None
+        try:
+            try:
+                server = MCPServerStreamableHttp(
+                    params=MCPServerStreamableHttpParams(url=self.url),
+                    name="MCPServerClient_Shared",
+                    cache_tools_list=True
+                )
+                await server.connect()
+            except Exception as e:
+                print(f"❌ [AGENT-API] MCP Server connection failed: {e}")
+                self._failed_at = time.monotonic()
+                if server is not None:
+                    try:
+                        await server.cleanup()
+                    except Exception as cleanup_error:
+                        print(f"⚠️ [AGENT-API] Error cleaning up failed MCP connection: {cleanup_error}")
+                return
+            self.server = server
+            self._failed_at = None
+            self._last_used = time.monotonic()
+        finally:
+            # Always release waiters, whatever happened while connecting
+            self._ready.set()
+
+        try:
+            await self._closing.wait()
+        finally:
+            self.server = None
+            await server.cleanup()
+
+    async def get_servers(self) -> List[MCPServerStreamableHttp]:
+        """Return the shared MCP server, (re)connecting if there is no live connection"""
+        server = self.server
+        if server is not None and time.monotonic() - self._last_used > MCP_IDLE_PING_AFTER:
+            self._last_used = time.monotonic()  # One ping per idle period, not one per waiting request
+            await self._reset_if_dead(server)
+        
+        async with self._lock:
+            if self._task is None or self._task.done():
+                if self._failed_at is not None and time.monotonic() - self._failed_at < MCP_RECONNECT_COOLDOWN:
+                    return []  # Recently unreachable; run without MCP tools instead of retrying per request
+                self._ready.clear()
+                self._closing.clear()
+                self._task = asyncio.create_task(self._run())
+            ready = self._ready
+        await ready.wait()
+        if self.server:
+            self._last_used = time.monotonic()
+            return [self.server]
+        return []
+
+    async def reset_if_unhealthy(self) -> None:
+        """After a failed run, reconnect only if the MCP session itself no longer answers a ping"""
+        server = self.server
+        if server is not None:
+            await self._reset_if_dead(server)
+
+    async def _reset_if_dead(self, server: MCPServerStreamableHttp) -> None:
+        session = server.session
+        try:
+            if session is None:
+                raise ConnectionError("session closed")
+            await asyncio.wait_for(session.send_ping(), MCP_PING_TIMEOUT)
+        except Exception as e:
+            # Another request may already have replaced this connection
+            if self.server is server:
+                print(f"⚠️ [AGENT-API] MCP connection unhealthy, reconnecting: {e}")
+                await self.reset()
+
+    async def reset(self) -> None:
+        """Close the current connection so the next request reconnects"""
+        async with self._lock:
+            task = self._task
+            self._task = None
+            if task is not None:
+                self._closing.set()
+                try:
+                    await task
+                except Exception as e:
+                    print(f"⚠️ [AGENT-API] Error closing MCP connection: {e}")
 
 # --- FastAPI App Setup ---
 app = FastAPI()
 
 # MCP server URL - configurable for production
 MCP_SERVER_URL = os.getenv("MCP_SERVER_URL", "http://mcp_server:8000/mcp")
+mcp_connection = SharedMCPConnection(MCP_SERVER_URL)
+prune_task: Optional[asyncio.Task] = None
 
 @app.post("/invoke", response_model=InvokeResponse)
 async def invoke_agent(request: InvokeRequest):
@@ -102,9 +309,6 @@ async def invoke_agent(request: InvokeRequest):
 
     await ensure_db_initialized()
     
-    agent_hooks = CustomAgentHooks(display_name="FastAPI_Agent_NonStream")
-    mcp_params = MCPServerStreamableHttpParams(url=MCP_SERVER_URL)
-    
     current_thread_id = request.thread_id
     new_thread_created = False
     
@@ -116,84 +320,54 @@ async def invoke_agent(request: InvokeRequest):
             thread_type = thread_info['thread_type']
     
     if not current_thread_id or not thread_info:
-        if request.history_mode == "api":
-            current_thread_id = f"api_thread_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
-            thread_type = "api"
-        elif request.history_mode == "local_text":
-            current_thread_id = f"text_thread_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
-            thread_type = "text"
-        else: # none or other
-            current_thread_id = f"temp_thread_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
-            thread_type = "temp"
+        current_thread_id, thread_type = new_thread_id(request.history_mode)
         new_thread_created = True
         await db_manager.create_thread(current_thread_id, thread_type, request.user_id)
         print(f"New thread ID created for API request: {current_thread_id}")
 
-    async with MCPServerStreamableHttp(
-        params=mcp_params,
-        name=f"MCPServerClient_NonStream_{current_thread_id}",
-        cache_tools_list=True
-    ) as mcp_http_server:
-
-        # Determine which tools to include
-        openai_tools = []
-        if request.enable_tools:
-            if request.tool_types:
-                openai_tools = get_tools_by_type(request.tool_types)
-            else:
-                openai_tools = get_all_tools()  # Use all tools by default
-
-        agent = Agent[AgentCustomContext](
-            name="FastAPIAgent",
-            model="gpt-4.1", # TODO: Make model configurable
-            instructions=main_system_prompt,
-            hooks=agent_hooks,
-            tools=openai_tools,  # Add OpenAI tools
-            mcp_servers=[mcp_http_server]  # Keep existing MCP integration
-        )
-
-        custom_context = AgentCustomContext(
-            user_id=request.user_id,
-            current_thread_id=current_thread_id,
-            session_start_time=datetime.now(timezone.utc).isoformat()
-        )
-
-        prompt = request.user_input
-        kwargs_for_run = {}
-
-        if request.history_mode == "local_text" and current_thread_id:
-            local_history_content = await load_local_text_thread_history(current_thread_id)
-            if local_history_content:
-                prompt = f"{local_history_content.strip()}\n\nUser: {request.user_input}\nAssistant:"
-            else:
-                prompt = f"User: {request.user_input}\nAssistant:"
-            print(f"(API using local text history from thread '{current_thread_id}')")
-        elif request.history_mode == "api" and current_thread_id:
-            latest_response_id = await get_latest_valid_response_id_from_api_thread(current_thread_id)
-            if latest_response_id:
-                kwargs_for_run['previous_response_id'] = latest_response_id
-                print(f"(API using API history from thread '{current_thread_id}', prev_resp_id: {latest_response_id})")
-            else:
-                print(f"(API history mode for thread '{current_thread_id}', but no valid previous response ID found)")
-        
-        try:
-            result = await Runner.run(agent, prompt, context=custom_context, **kwargs_for_run)
-        except Exception as e:
-            print(f"Error during Runner.run: {e}")
-            raise HTTPException(status_code=500, detail=f"Agent execution error: {str(e)}")
+    mcp_servers = await mcp_connection.get_servers()
+    agent = get_agent("FastAPIAgent", request, mcp_servers)
 
-        assistant_output = result.final_output if result else "Error: No output from agent."
+    custom_context = AgentCustomContext(
+        user_id=request.user_id,
+        current_thread_id=current_thread_id,
+        session_start_time=datetime.now(timezone.utc).isoformat()
+    )
 
-        if request.history_mode == "local_text" and current_thread_id:
-            await append_to_local_text_thread_history(current_thread_id, request.user_input, assistant_output)
-        elif request.history_mode == "api" and current_thread_id and result and result.last_response_id:
-            await add_response_to_api_thread_history(current_thread_id, result.last_response_id)
-        
-        return InvokeResponse(
-            assistant_output=assistant_output,
-            thread_id=current_thread_id,
-            new_thread_created=new_thread_created
-        )
+    prompt = request.user_input
+    kwargs_for_run = {}
+
+    if request.history_mode == "local_text" and current_thread_id:
+        local_history_content = await load_local_text_thread_history(current_thread_id)
+        prompt = build_text_prompt(local_history_content, request.user_input)
+        print(f"(API using local text history from thread '{current_thread_id}')")
+    elif request.history_mode == "api" and current_thread_id:
+        latest_response_id = await get_latest_valid_response_id_from_api_thread(current_thread_id)
+        if latest_response_id:
+            kwargs_for_run['previous_response_id'] = latest_response_id
+            print(f"(API using API history from thread '{current_thread_id}', prev_resp_id: {latest_response_id})")
+        else:
+            print(f"(API history mode for thread '{current_thread_id}', but no valid previous response ID found)")
+    
+    try:
+        result = await Runner.run(agent, prompt, context=custom_context, **kwargs_for_run)
+    except Exception as e:
+        print(f"Error during Runner.run: {e}")
+        await mcp_connection.reset_if_unhealthy()
+        raise HTTPException(status_code=500, detail=f"Agent execution error: {str(e)}")
+
+    assistant_output = result.final_output if result else "Error: No output from agent."
+
+    if request.history_mode == "local_text" and current_thread_id:
+        await append_to_local_text_thread_history(current_thread_id, request.user_input, assistant_output)
+    elif request.history_mode == "api" and current_thread_id and result and result.last_response_id:
+        await add_response_to_api_thread_history(current_thread_id, result.last_response_id)
+    
+    return InvokeResponse(
+        assistant_output=assistant_output,
+        thread_id=current_thread_id,
+        new_thread_created=new_thread_created
+    )
 
 @app.post("/invoke_stream")
 async def invoke_agent_stream(request: InvokeRequest):
@@ -203,12 +377,9 @@ async def invoke_agent_stream(request: InvokeRequest):
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OPENAI_API_KEY not configured on server.")
     
-    async def generate_stream() -> AsyncGenerator[str, None]:
+    async def generate_stream() -> AsyncGenerator[bytes, None]:
         await ensure_db_initialized()
         
-        agent_hooks = CustomAgentHooks(display_name="FastAPI_Agent_Stream")
-        mcp_params = MCPServerStreamableHttpParams(url=MCP_SERVER_URL)
-        
         current_thread_id = request.thread_id
         new_thread_created = False
         
@@ -220,116 +391,135 @@ async def invoke_agent_stream(request: InvokeRequest):
                 thread_type = thread_info['thread_type']
         
         if not current_thread_id or not thread_info:
-            if request.history_mode == "api":
-                current_thread_id = f"api_thread_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
-                thread_type = "api"
-            elif request.history_mode == "local_text":
-                current_thread_id = f"text_thread_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
-                thread_type = "text"
-            else:  # none or other
-                current_thread_id = f"temp_thread_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
-                thread_type = "temp"
+            current_thread_id, thread_type = new_thread_id(request.history_mode)
             new_thread_created = True
             await db_manager.create_thread(current_thread_id, thread_type, request.user_id)
             print(f"New thread ID created for streaming API request: {current_thread_id}")
         
         # Send initial metadata
-        yield f"data: {json.dumps({'type': 'metadata', 'thread_id': current_thread_id, 'new_thread_created': new_thread_created})}\n\n"
+        yield sse_event({'type': 'metadata', 'thread_id': current_thread_id, 'new_thread_created': new_thread_created})
         
         try:
-            async with MCPServerStreamableHttp(
-                params=mcp_params,
-                name=f"MCPServerClient_Stream_{current_thread_id}",
-                cache_tools_list=True
-            ) as mcp_http_server:
-                
-                # Determine which tools to include for streaming
-                openai_tools = []
-                if request.enable_tools:
-                    if request.tool_types:
-                        openai_tools = get_tools_by_type(request.tool_types)
-                    else:
-                        openai_tools = get_all_tools()  # Use all tools by default
-
-                agent = Agent[AgentCustomContext](
-                    name="FastAPIAgent_Stream",
-                    model="gpt-4.1",
-                    instructions=main_system_prompt,
-                    hooks=agent_hooks,
-                    tools=openai_tools,  # Add OpenAI tools
-                    mcp_servers=[mcp_http_server]  # Keep existing MCP integration
-                )
-                
-                custom_context = AgentCustomContext(
-                    user_id=request.user_id,
-                    current_thread_id=current_thread_id,
-                    session_start_time=datetime.now(timezone.utc).isoformat()
-                )
-                
-                # Prepare prompt and kwargs
-                prompt = request.user_input
-                kwargs_for_run = {}
-                
-                if request.history_mode == "local_text" and current_thread_id:
-                    local_history_content = await load_local_text_thread_history(current_thread_id)
-                    prompt = f"{local_history_content}User: {request.user_input}\nAssistant:"
-                    print(f"(Using local text history from thread '{current_thread_id}' for streaming)")
-                elif request.history_mode == "api" and current_thread_id:
-                    previous_api_id = await get_latest_valid_response_id_from_api_thread(current_thread_id)
-                    if previous_api_id:
-                        kwargs_for_run["previous_response_id"] = previous_api_id
-                        print(f"(Using API history ID: {previous_api_id} from thread '{current_thread_id}' for streaming)")
-                    else:
-                        print(f"(API history mode for thread '{current_thread_id}', but no valid previous response ID found)")
-                
-                # Run the agent in streaming mode
-                result_stream = Runner.run_streamed(agent, prompt, context=custom_context, **kwargs_for_run)
-                
-                # Process stream events
-                final_output = ""
-                last_message_id = None
-                
-                async for event in result_stream.stream_events():
-                    if event.type == "raw_response_event" and hasattr(event, 'data'):
-                        if hasattr(event.data, 'type') and event.data.type == "response.output_text.delta":
-                            if hasattr(event.data, 'delta') and event.data.delta is not None:
-                                final_output += event.data.delta
-                                # Send text delta
-                                yield f"data: {json.dumps({'type': 'delta', 'content': event.data.delta})}\n\n"
+            mcp_servers = await mcp_connection.get_servers()
+            agent = get_agent("FastAPIAgent_Stream", request, mcp_servers)
+            
+            custom_context = AgentCustomContext(
+                user_id=request.user_id,
+                current_thread_id=current_thread_id,
+                session_start_time=datetime.now(timezone.utc).isoformat()
+            )
+            
+            # Prepare prompt and kwargs
+            prompt = request.user_input
+            kwargs_for_run = {}
+            
+            if request.history_mode == "local_text" and current_thread_id:
+                local_history_content = await load_local_text_thread_history(current_thread_id)
+                prompt = build_text_prompt(local_history_content, request.user_input)
+                print(f"(Using local text history from thread '{current_thread_id}' for streaming)")
+            elif request.history_mode == "api" and current_thread_id:
+                previous_api_id = await get_latest_valid_response_id_from_api_thread(current_thread_id)
+                if previous_api_id:
+                    kwargs_for_run["previous_response_id"] = previous_api_id
+                    print(f"(Using API history ID: {previous_api_id} from thread '{current_thread_id}' for streaming)")
+                else:
+                    print(f"(API history mode for thread '{current_thread_id}', but no valid previous response ID found)")
+            
+            # Run the agent in streaming mode
+            result_stream = Runner.run_streamed(agent, prompt, context=custom_context, **kwargs_for_run)
+            
+            # Process stream events
+            final_output = ""
+            last_message_id = None
+            pending_delta = ""
+            frame_started = 0.0
+            
+            # Pull events through a pending task so a stalled model can't hold a
+            # partial frame: when the frame's time runs out it is flushed while
+            # the same task keeps waiting for the next event
+            events = result_stream.stream_events().__aiter__()
+            next_event = None
+            try:
+                while True:
+                    if next_event is None:
+                        next_event = asyncio.ensure_future(events.__anext__())
+                    if pending_delta:
+                        remaining = STREAM_FRAME_MAX_DELAY - (time.monotonic() - frame_started)
+                        done, _ = await asyncio.wait((next_event,), timeout=max(remaining, 0))
+                        if not done:
+                            yield sse_event({'type': 'delta', 'content': pending_delta})
+                            pending_delta = ""
+                            continue
+                    try:
+                        event = await next_event
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        next_event = None
                     
-                    elif event.type == "run_item_stream_event" and hasattr(event, 'item'):
-                        if hasattr(event.item, 'type') and event.item.type == "message_output_item":
-                            current_message_id = getattr(event.item, 'id', getattr(event.item, 'message_id', None))
+                    event_type = event.type
+                    data = getattr(event, 'data', None) if event_type == RAW_RESPONSE_EVENT else None
+                    if getattr(data, 'type', None) == OUTPUT_TEXT_DELTA:
+                        delta = getattr(data, 'delta', None)
+                        if delta:
+                            final_output += delta
+                            if not pending_delta:
+                                frame_started = time.monotonic()
+                            pending_delta += delta
+                            # Send text deltas in frames rather than one event per token
+                            if len(pending_delta) >= STREAM_FRAME_MIN_CHARS:
+                                yield sse_event({'type': 'delta', 'content': pending_delta})
+                                pending_delta = ""
+                        continue
+                    
+                    # Any other event (tool calls, message boundaries, ...) can precede a long pause,
+                    # so don't hold buffered text back behind it
+                    if pending_delta:
+                        yield sse_event({'type': 'delta', 'content': pending_delta})
+                        pending_delta = ""
+                    
+                    if event_type == RUN_ITEM_STREAM_EVENT:
+                        item = getattr(event, 'item', None)
+                        if getattr(item, 'type', None) == MESSAGE_OUTPUT_ITEM:
+                            current_message_id = getattr(item, 'id', None) or getattr(item, 'message_id', None)
                             if current_message_id:
                                 last_message_id = current_message_id
                                 # Send message ID update
-                                yield f"data: {json.dumps({'type': 'message_id', 'message_id': current_message_id})}\n\n"
+                                yield sse_event({'type': 'message_id', 'message_id': current_message_id})
                                 print(f"(Stream: Message unit processed, ID: {current_message_id})")
-                
-                # Handle history updates after stream completion
-                if request.history_mode == "local_text" and current_thread_id and final_output:
-                    await append_to_local_text_thread_history(current_thread_id, request.user_input, final_output)
-                    print(f"(Local text history updated for thread '{current_thread_id}')")
-                elif request.history_mode == "api" and current_thread_id:
-                    if last_message_id:
-                        await add_response_to_api_thread_history(current_thread_id, last_message_id)
-                        print(f"(API history updated for thread '{current_thread_id}' with response ID: {last_message_id})")
-                    else:
-                        # Fallback: try to get response ID from result object
-                        fallback_id = getattr(result_stream, 'last_response_id', None)
-                        if fallback_id:
-                            await add_response_to_api_thread_history(current_thread_id, fallback_id)
-                            print(f"(API history updated with fallback response ID: {fallback_id})")
-                
-                # Send completion event
-                yield f"data: {json.dumps({'type': 'done', 'thread_id': current_thread_id, 'final_output': final_output})}\n\n"
-                
+            finally:
+                if next_event is not None:
+                    next_event.cancel()
+            
+            if pending_delta:
+                yield sse_event({'type': 'delta', 'content': pending_delta})
+            
+            # Handle history updates after stream completion
+            history_write = None
+            if request.history_mode == "local_text" and current_thread_id and final_output:
+                history_write = append_to_local_text_thread_history(current_thread_id, request.user_input, final_output)
+            elif request.history_mode == "api" and current_thread_id:
+                # Fallback: try to get response ID from result object
+                response_id = last_message_id or getattr(result_stream, 'last_response_id', None)
+                if response_id:
+                    history_write = add_response_to_api_thread_history(current_thread_id, response_id)
+            
+            if history_write is not None:
+                # Clients send their next turn as soon as they see done, so the write must be
+                # committed first; shielded so a disconnect mid-write doesn't cancel it halfway
+                await asyncio.shield(start_history_write(history_write))
+                print(f"(History updated for thread '{current_thread_id}')")
+            
+            # Send completion event
+            yield sse_event({'type': 'done', 'thread_id': current_thread_id, 'final_output': final_output})
+            
         except Exception as e:
             print(f"Error during streaming: {e}")
-            yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
+            await mcp_connection.reset_if_unhealthy()
+            yield sse_event({'type': 'error', 'content': str(e)})
         finally:
             # Ensure the stream always ends properly
-            yield f"data: {json.dumps({'type': 'stream_end'})}\n\n"
+            yield sse_event({'type': 'stream_end'})
     
     return StreamingResponse(
         generate_stream(),
@@ -406,30 +596,25 @@ async def startup_event():
         print(f"❌ [AGENT-API] Database connection failed: {e}")
         raise
     
-    # Test MCP server connection
-    try:
-        import httpx
-        if MCP_SERVER_URL.endswith('/mcp'):
-            health_url = MCP_SERVER_URL[:-4] + '/health'
-        else:
-            health_url = MCP_SERVER_URL.rstrip('/') + '/health'
-        
-        print(f"🔧 [AGENT-API] Testing MCP server health at: {health_url}")
-        
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(health_url)
-            if response.status_code == 200:
-                print("✅ [AGENT-API] MCP Server connection successful")
-            else:
-                print(f"⚠️ [AGENT-API] MCP Server health check responded with status {response.status_code}")
-    except Exception as e:
-        print(f"❌ [AGENT-API] MCP Server connection failed: {e}")
+    # Open the shared MCP connection up front; requests reconnect lazily if it is down
+    if await mcp_connection.get_servers():
+        print("✅ [AGENT-API] Shared MCP connection established")
+    else:
         print("⚠️ [AGENT-API] Will continue without MCP tools")
     
+    global prune_task
+    prune_task = asyncio.create_task(prune_expired_history_loop())
+    
     print("🎉 [AGENT-API] Startup complete!")
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    if prune_task:
+        prune_task.cancel()
+    await mcp_connection.reset()
+    print("👋 [AGENT-API] MCP connection closed")
+    if history_write_tasks:
+        await asyncio.gather(*history_write_tasks, return_exceptions=True)
     await db_manager.close()
     print("👋 [AGENT-API] Database connection pool closed")
 
@@ -1,5 +1,5 @@
 import os
-import json
+import orjson
 import httpx
 import chainlit as cl
 from chainlit.input_widget import Select, Switch
@@ -25,6 +25,20 @@ openai_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 # Configuration
 API_BASE_URL = os.getenv("API_BASE_URL", "http://agent_app:8001")
 DEFAULT_HISTORY_MODE = os.getenv("DEFAULT_HISTORY_MODE", "local_text")
+STREAM_FLUSH_INTERVAL = 0.016  # Seconds between coalesced stream_token updates (~one frame)
+STREAM_QUEUE_SIZE = 128  # Max SSE events buffered between the network reader and the UI
+STREAM_END = object()  # End-of-stream marker queued by the SSE reader
+SSE_FRAME_SEPARATOR = b"\n\n"
+SSE_DATA_PREFIX = b"data: "
+SSE_EVENT_PREFIX = SSE_DATA_PREFIX + b"{"  # Agent API events are always JSON objects
+
+# Shared HTTP client for the agent API, reused across all messages and users
+http_client = httpx.AsyncClient(
+    base_url=API_BASE_URL,
+    http2=True,  # Negotiated via TLS ALPN (e.g. behind an HTTPS proxy); plain http:// stays on HTTP/1.1 keep-alive
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100)
+)
 
 # OpenAI Agent tools for direct mode (same as in openai_tools.py)
 OPENAI_AGENT_TOOLS = [
@@ -101,12 +115,11 @@ async def on_chat_start():
     
     # Test backend connection
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(f"{API_BASE_URL}/health")
-            if response.status_code == 200:
-                print("✅ [CHAINLIT-WEB] Agent API connection successful")
-            else:
-                print(f"⚠️ [CHAINLIT-WEB] Agent API responded with status {response.status_code}")
+        response = await http_client.get("/health", timeout=5.0)
+        if response.status_code == 200:
+            print("✅ [CHAINLIT-WEB] Agent API connection successful")
+        else:
+            print(f"⚠️ [CHAINLIT-WEB] Agent API responded with status {response.status_code}")
     except Exception as e:
         print(f"❌ [CHAINLIT-WEB] Agent API connection failed: {e}")
     
@@ -233,19 +246,19 @@ async def call_mcp_tool(tool_use):
             break
     
     if not mcp_name:
-        current_step.output = json.dumps({"error": f"Tool {tool_name} not found in any MCP connection"})
+        current_step.output = orjson.dumps({"error": f"Tool {tool_name} not found in any MCP connection"}).decode()
         return current_step.output
     
     mcp_session, _ = cl.context.session.mcp_sessions.get(mcp_name)
     
     if not mcp_session:
-        current_step.output = json.dumps({"error": f"MCP {mcp_name} session not found"})
+        current_step.output = orjson.dumps({"error": f"MCP {mcp_name} session not found"}).decode()
         return current_step.output
     
     try:
         current_step.output = await mcp_session.call_tool(tool_name, tool_input)
     except Exception as e:
-        current_step.output = json.dumps({"error": str(e)})
+        current_step.output = orjson.dumps({"error": str(e)}).decode()
     
     return current_step.output
 
@@ -284,12 +297,11 @@ async def handle_backend_mode(message: cl.Message):
     endpoint = "/invoke_stream" if streaming else "/invoke"
     
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            if streaming:
-                await handle_streaming_response(client, endpoint, request_data, message)
-            else:
-                await handle_non_streaming_response(client, endpoint, request_data)
-                
+        if streaming:
+            await handle_streaming_response(http_client, endpoint, request_data, message)
+        else:
+            await handle_non_streaming_response(http_client, endpoint, request_data)
+            
     except httpx.ReadTimeout:
         await cl.Message(
             content="⏱️ Request timed out. Please try again with a simpler query."
@@ -359,56 +371,105 @@ async def handle_streaming_response(client: httpx.AsyncClient, endpoint: str, re
     msg = cl.Message(content="")
     await msg.send()
     
-    full_response = ""
-    backend_thread_id = None
-    
-    try:
-        async with client.stream(
-            "POST",
-            f"{API_BASE_URL}{endpoint}",
-            json=request_data,
-            headers={"Accept": "text/event-stream"}
-        ) as response:
-            response.raise_for_status()
-            
-            async for line in response.aiter_lines():
-                if line.startswith("data: "):
-                    try:
-                        data = json.loads(line[6:])
+    loop = asyncio.get_running_loop()
+    
+    # Bounded queue between the SSE reader and the UI writer. Deltas are queued as strings and
+    # UI events (done/error) as dicts; STREAM_END marks the end of the stream. A slow websocket
+    # makes the reader wait on put() instead of buffering the whole response in memory.
+    events: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    
+    async def read_events():
+        cancelled = False
+        try:
+            async with client.stream(
+                "POST",
+                endpoint,
+                json=request_data,
+                headers={"Accept": "text/event-stream"}  # No-buffering is signalled by the agent's response headers
+            ) as response:
+                response.raise_for_status()
+                
+                buffer = bytearray()
+                async for chunk in response.aiter_bytes(chunk_size=16384):
+                    buffer += chunk
+                    while (end := buffer.find(SSE_FRAME_SEPARATOR)) != -1:
+                        frame = bytes(buffer[:end])
+                        del buffer[:end + len(SSE_FRAME_SEPARATOR)]
+                        # Only JSON object payloads are events; skip comments, heartbeats and sentinels without parsing
+                        if not frame.startswith(SSE_EVENT_PREFIX):
+                            continue
+                        try:
+                            data = orjson.loads(frame[len(SSE_DATA_PREFIX):])
+                        except orjson.JSONDecodeError:
+                            continue
+                        
+                        if data["type"] == "delta":
+                            await events.put(data.get("content", ""))
                         
-                        if data["type"] == "metadata":
+                        elif data["type"] == "metadata":
                             # Store backend thread ID for future requests
-                            backend_thread_id = data["thread_id"]
-                            cl.user_session.set("backend_thread_id", backend_thread_id)
+                            cl.user_session.set("backend_thread_id", data["thread_id"])
                             
                             if data.get("new_thread_created"):
                                 # This message will be associated with the new Chainlit thread
                                 # The thread will automatically appear in the sidebar
                                 pass
                         
-                        elif data["type"] == "delta":
-                            content = data.get("content", "")
-                            full_response += content
-                            await msg.stream_token(content)
-                        
                         elif data["type"] == "message_id":
                             print(f"Message ID: {data['message_id']}")
                         
-                        elif data["type"] == "done":
-                            await msg.update()
-                        
-                        elif data["type"] == "error":
-                            await cl.Message(
-                                content=f"❌ Error: {data['content']}"
-                            ).send()
-                            
-                    except json.JSONDecodeError:
-                        continue
-                        
+                        elif data["type"] in ("done", "error"):
+                            await events.put(data)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            try:
+                events.put_nowait(STREAM_END)
+            except asyncio.QueueFull:
+                # Only wait for room if the renderer is still draining; after cancel nobody reads
+                if not cancelled:
+                    await events.put(STREAM_END)
+    
+    async def render_events():
+        item = await events.get()
+        while item is not STREAM_END:
+            if isinstance(item, str):
+                # Coalesce every delta that arrives within one flush interval into a single update
+                batch = [item]
+                following = None  # First non-delta item (event or STREAM_END) read while coalescing
+                deadline = loop.time() + STREAM_FLUSH_INTERVAL
+                while (remaining := deadline - loop.time()) > 0:
+                    try:
+                        next_item = await asyncio.wait_for(events.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    if not isinstance(next_item, str):
+                        following = next_item
+                        break
+                    batch.append(next_item)
+                await msg.stream_token("".join(batch))
+                item = following if following is not None else await events.get()
+                continue
+            
+            if item["type"] == "done":
+                await msg.update()
+            elif item["type"] == "error":
+                await cl.Message(
+                    content=f"❌ Error: {item['content']}"
+                ).send()
+            item = await events.get()
+    
+    reader = asyncio.create_task(read_events())
+    try:
+        await render_events()
+        await reader  # Surface HTTP/connection errors raised while reading
     except Exception as e:
         await cl.Message(
             content=f"❌ Streaming error: {str(e)}"
         ).send()
+    finally:
+        reader.cancel()
 
 async def handle_non_streaming_response(client: httpx.AsyncClient, endpoint: str, request_data: Dict[str, Any]):
     """Handle non-streaming responses from the API"""
@@ -417,7 +478,7 @@ async def handle_non_streaming_response(client: httpx.AsyncClient, endpoint: str
     
     try:
         response = await client.post(
-            f"{API_BASE_URL}{endpoint}",
+            endpoint,
             json=request_data
         )
         response.raise_for_status()
@@ -456,6 +517,12 @@ async def on_chat_end():
     if backend_thread_id:
         print(f"Chat ended. User: {user_id}, Backend Thread: {backend_thread_id}")
 
+if hasattr(cl, "on_app_shutdown"):  # Lifecycle hook is only available in newer Chainlit releases
+    @cl.on_app_shutdown
+    async def on_app_shutdown():
+        """Close the shared agent API client"""
+        await http_client.aclose()
+
 @cl.on_chat_resume
 async def on_chat_resume(thread: Dict):
     """Resume a previous conversation thread"""
@@ -1,7 +1,10 @@
 import os
+import time
 import asyncio
-from datetime import datetime, timezone
-from typing import List, Optional, Dict, Any
+from urllib.parse import urlparse
+from datetime import datetime
+from collections import OrderedDict
+from typing import List, Optional, Dict, Any, Tuple
 from contextlib import asynccontextmanager
 
 import asyncpg
@@ -12,10 +15,45 @@ load_dotenv()
 
 DATABASE_URL = os.getenv("DB_URL")
 
+# Pool bounds; the default max of 3 suits the Supabase basic plan's connection limit
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "3"))
+
+# Supabase's transaction-mode pooler (pgbouncer on port 6543) can't keep prepared statements
+# across transactions, so the statement cache is only enabled for direct/session connections
+PGBOUNCER_TRANSACTION_PORT = 6543
+
+def get_statement_cache_size(database_url: Optional[str]) -> int:
+    """Pick the asyncpg prepared-statement cache size for a connection URL"""
+    configured = os.getenv("DB_STATEMENT_CACHE_SIZE")
+    if configured is not None:
+        return int(configured)
+    if database_url and urlparse(database_url).port == PGBOUNCER_TRANSACTION_PORT:
+        return 0
+    return 100  # asyncpg default
+
+# Bump whenever the DDL in ensure_schema changes so existing databases re-run it
+SCHEMA_VERSION = 1
+
+TEXT_HISTORY_CACHE_SIZE = 256  # Threads whose formatted text history is kept in memory
+USER_THREADS_CACHE_TTL = 30  # Seconds a user's thread listing is served from memory
+USER_THREADS_CACHE_SIZE = 1024  # Users whose thread listing is kept in memory
+
+def format_text_turn(user_input: str, assistant_response: str) -> str:
+    """Format one stored turn the way it appears in a text history"""
+    return f"User: {user_input}\nAssistant: {assistant_response}\n"
+
 class DatabaseManager:
     def __init__(self):
         self.pool: Optional[Pool] = None
         self.schema_initialized = False
+        # LRU of thread_id -> (row count, max sequence_number, formatted text history); checked against
+        # the table on every read, so writes from other workers are picked up
+        self._text_history_cache: OrderedDict[str, Tuple[int, Optional[int], str]] = OrderedDict()
+        # LRU of user_id -> (monotonic time fetched, thread listing), dropped whenever one of the user's threads changes
+        self._user_threads_cache: OrderedDict[str, Tuple[float, List[Dict[str, Any]]]] = OrderedDict()
+        # user_id -> token of the listing fetch in flight; invalidation drops it so a stale listing isn't cached
+        self._user_threads_fills: Dict[str, object] = {}
     
     async def initialize(self):
         """Initialize the database connection pool"""
@@ -24,13 +62,18 @@ class DatabaseManager:
             try:
                 self.pool = await asyncpg.create_pool(
                     DATABASE_URL,
-                    min_size=1,
-                    max_size=3,  # Reduced from 10 to 3 for basic plan
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
                     command_timeout=60,
-                    statement_cache_size=0  # Disable prepared statements to avoid conflicts
+                    max_inactive_connection_lifetime=300,
+                    statement_cache_size=get_statement_cache_size(DATABASE_URL)
                 )
                 print("✅ [DATABASE] Connection pool created successfully")
-                await self.ensure_schema()
+                if os.getenv("RESET_DB") == "1":
+                    print("⚠️ [DATABASE] RESET_DB=1 - dropping and recreating agent tables")
+                    await self.reset_schema()
+                elif not self.schema_initialized:
+                    await self.ensure_schema()
                 print("✅ [DATABASE] Schema initialization complete")
             except Exception as e:
                 print(f"❌ [DATABASE] Initialization failed: {e}")
@@ -48,68 +91,125 @@ class DatabaseManager:
             return
             
         async with self.pool.acquire() as conn:
-            # Create agent schema for our backend data
-            await conn.execute("CREATE SCHEMA IF NOT EXISTS agent")
+            # Skip the DDL entirely when the recorded schema version is current
+            try:
+                # An empty schema_meta (e.g. left by an older non-transactional init) counts as version 0
+                version = await conn.fetchval("SELECT version FROM agent.schema_meta") or 0
+            except (asyncpg.UndefinedTableError, asyncpg.InvalidSchemaNameError):
+                version = 0  # Created before schema_meta existed (or not created at all)
+            if version == SCHEMA_VERSION:
+                self.schema_initialized = True
+                return
             
-            # For fresh deployments, drop and recreate tables to ensure proper schema
-            # This is safe for a boilerplate since users start fresh
+            # DDL and the version record commit together, so a crash midway never records a version
+            async with conn.transaction():
+                # Create agent schema for our backend data
+                await conn.execute("CREATE SCHEMA IF NOT EXISTS agent")
+                
+                # Create threads table with user_id from start
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS agent.threads (
+                        id VARCHAR(255) PRIMARY KEY,
+                        thread_type VARCHAR(50) NOT NULL CHECK (thread_type IN ('api', 'text', 'temp')),
+                        user_id VARCHAR(255),
+                        user_name VARCHAR(255),
+                        created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+                        last_activity TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+                    )
+                """)
+                
+                # Create index for user threads
+                await conn.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_threads_user ON agent.threads(user_id, last_activity DESC)
+                """)
+                
+                # Create api_history table
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS agent.api_history (
+                        id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+                        thread_id VARCHAR(255) NOT NULL REFERENCES agent.threads(id) ON DELETE CASCADE,
+                        response_id VARCHAR(255) NOT NULL,
+                        created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+                        expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+                        UNIQUE(thread_id, response_id)
+                    )
+                """)
+                
+                # Create text_history table
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS agent.text_history (
+                        id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
+                        thread_id VARCHAR(255) NOT NULL REFERENCES agent.threads(id) ON DELETE CASCADE,
+                        user_input TEXT NOT NULL,
+                        assistant_response TEXT NOT NULL,
+                        created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+                        sequence_number BIGSERIAL
+                    )
+                """)
+                
+                if version < 1:
+                    # Version 0 tables have sequence_number INTEGER NOT NULL filled in per thread by the
+                    # app. Back it with a sequence instead, starting past every existing value so each
+                    # thread's ordering is preserved. Harmless on a freshly created table.
+                    await conn.execute("""
+                        CREATE SEQUENCE IF NOT EXISTS agent.text_history_sequence_number_seq
+                        OWNED BY agent.text_history.sequence_number
+                    """)
+                    await conn.execute("""
+                        ALTER TABLE agent.text_history
+                            ALTER COLUMN sequence_number TYPE BIGINT,
+                            ALTER COLUMN sequence_number SET DEFAULT nextval('agent.text_history_sequence_number_seq')
+                    """)
+                    await conn.execute("""
+                        SELECT setval('agent.text_history_sequence_number_seq',
+                                      COALESCE(MAX(sequence_number), 0) + 1, false)
+                        FROM agent.text_history
+                    """)
+                
+                # Create indexes
+                await conn.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_api_history_thread_expires 
+                    ON agent.api_history(thread_id, expires_at DESC)
+                """)
+                
+                # Serves the latest-response lookup (ORDER BY created_at DESC LIMIT 1) without a sort
+                await conn.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_api_history_thread_created 
+                    ON agent.api_history(thread_id, created_at DESC)
+                """)
+                
+                await conn.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_text_history_thread_seq 
+                    ON agent.text_history(thread_id, sequence_number)
+                """)
+                
+                # Record the schema version (single-row table)
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS agent.schema_meta (
+                        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                        version INTEGER NOT NULL
+                    )
+                """)
+                await conn.execute("""
+                    INSERT INTO agent.schema_meta (id, version) VALUES (TRUE, $1)
+                    ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version
+                """, SCHEMA_VERSION)
+            
+        self.schema_initialized = True
+    
+    async def reset_schema(self):
+        """Drop all agent tables and recreate them (destroys existing history)"""
+        async with self.pool.acquire() as conn:
             await conn.execute("DROP TABLE IF EXISTS agent.text_history CASCADE")
             await conn.execute("DROP TABLE IF EXISTS agent.api_history CASCADE")
             await conn.execute("DROP TABLE IF EXISTS agent.threads CASCADE")
-            
-            # Create threads table with user_id from start
-            await conn.execute("""
-                CREATE TABLE agent.threads (
-                    id VARCHAR(255) PRIMARY KEY,
-                    thread_type VARCHAR(50) NOT NULL CHECK (thread_type IN ('api', 'text', 'temp')),
-                    user_id VARCHAR(255),
-                    user_name VARCHAR(255),
-                    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
-                    last_activity TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
-                )
-            """)
-            
-            # Create index for user threads
-            await conn.execute("""
-                CREATE INDEX idx_threads_user ON agent.threads(user_id, last_activity DESC)
-            """)
-            
-            # Create api_history table
-            await conn.execute("""
-                CREATE TABLE agent.api_history (
-                    id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
-                    thread_id VARCHAR(255) NOT NULL REFERENCES agent.threads(id) ON DELETE CASCADE,
-                    response_id VARCHAR(255) NOT NULL,
-                    created_at TIMESTAMP WITH TIME ZONE NOT NULL,
-                    expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
-                    UNIQUE(thread_id, response_id)
-                )
-            """)
-            
-            # Create text_history table
-            await conn.execute("""
-                CREATE TABLE agent.text_history (
-                    id UUID DEFAULT gen_random_uuid() PRIMARY KEY,
-                    thread_id VARCHAR(255) NOT NULL REFERENCES agent.threads(id) ON DELETE CASCADE,
-                    user_input TEXT NOT NULL,
-                    assistant_response TEXT NOT NULL,
-                    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
-                    sequence_number INTEGER NOT NULL
-                )
-            """)
-            
-            # Create indexes
-            await conn.execute("""
-                CREATE INDEX idx_api_history_thread_expires 
-                ON agent.api_history(thread_id, expires_at DESC)
-            """)
-            
-            await conn.execute("""
-                CREATE INDEX idx_text_history_thread_seq 
-                ON agent.text_history(thread_id, sequence_number)
-            """)
-            
-        self.schema_initialized = True
+            await conn.execute("DROP TABLE IF EXISTS agent.schema_meta")
+        
+        self.schema_initialized = False
+        self._text_history_cache.clear()
+        self._user_threads_cache.clear()
+        self._user_threads_fills.clear()
+        await self.ensure_schema()
     
     @asynccontextmanager
     async def acquire(self):
@@ -117,6 +217,11 @@ class DatabaseManager:
         async with self.pool.acquire() as conn:
             yield conn
     
+    def _invalidate_user_threads(self, user_id: Optional[str]) -> None:
+        if user_id is not None:
+            self._user_threads_cache.pop(user_id, None)
+            self._user_threads_fills.pop(user_id, None)
+    
     # Thread management methods
     async def create_thread(self, thread_id: str, thread_type: str, user_id: Optional[str] = None, user_name: Optional[str] = None) -> None:
         """Create a new thread entry with optional user association"""
@@ -127,6 +232,8 @@ class DatabaseManager:
                 ON CONFLICT (id) DO UPDATE SET
                     last_activity = NOW()
             """, thread_id, thread_type, user_id, user_name)
+        
+        self._invalidate_user_threads(user_id)
     
     async def get_thread(self, thread_id: str) -> Optional[Dict[str, Any]]:
         """Get thread information"""
@@ -140,41 +247,74 @@ class DatabaseManager:
     
     async def get_user_threads(self, user_id: str) -> List[Dict[str, Any]]:
         """Get all threads for a user"""
-        async with self.acquire() as conn:
-            rows = await conn.fetch("""
-                SELECT id, thread_type, user_name, created_at, last_activity
-                FROM agent.threads
-                WHERE user_id = $1
-                ORDER BY last_activity DESC
-            """, user_id)
-            return [dict(row) for row in rows]
+        cached = self._user_threads_cache.get(user_id)
+        if cached:
+            if time.monotonic() - cached[0] < USER_THREADS_CACHE_TTL:
+                self._user_threads_cache.move_to_end(user_id)
+                return cached[1]
+            del self._user_threads_cache[user_id]
+        
+        fill = object()
+        self._user_threads_fills[user_id] = fill
+        try:
+            async with self.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT id, thread_type, user_name, created_at, last_activity
+                    FROM agent.threads
+                    WHERE user_id = $1
+                    ORDER BY last_activity DESC
+                """, user_id)
+        finally:
+            # Only cache the listing if none of the user's threads changed while it was being read
+            cacheable = self._user_threads_fills.get(user_id) is fill
+            if cacheable:
+                del self._user_threads_fills[user_id]
+        
+        threads = [dict(row) for row in rows]
+        if cacheable:
+            self._user_threads_cache[user_id] = (time.monotonic(), threads)
+            if len(self._user_threads_cache) > USER_THREADS_CACHE_SIZE:
+                self._user_threads_cache.popitem(last=False)
+        return threads
     
     # API history methods
     async def add_api_history_entry(self, thread_id: str, response_id: str, created_at: datetime, expires_at: datetime) -> None:
         """Add an API history entry"""
         async with self.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO agent.api_history (thread_id, response_id, created_at, expires_at)
-                VALUES ($1, $2, $3, $4)
-                ON CONFLICT (thread_id, response_id) DO NOTHING
-            """, thread_id, response_id, created_at, expires_at)
-            
-            # Update thread last_activity
-            await conn.execute("""
+            # Insert the entry and bump thread last_activity in a single round-trip
+            user_id = await conn.fetchval("""
+                WITH inserted AS (
+                    INSERT INTO agent.api_history (thread_id, response_id, created_at, expires_at)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (thread_id, response_id) DO NOTHING
+                )
                 UPDATE agent.threads SET last_activity = NOW() WHERE id = $1
-            """, thread_id)
+                RETURNING user_id
+            """, thread_id, response_id, created_at, expires_at)
+        
+        self._invalidate_user_threads(user_id)
     
     async def get_latest_valid_api_response(self, thread_id: str) -> Optional[str]:
         """Get the latest valid (non-expired) API response ID"""
+        # Always read from the database: another worker may have written the thread's latest turn.
+        # This is a single LIMIT 1 probe on idx_api_history_thread_created.
         async with self.acquire() as conn:
-            row = await conn.fetchrow("""
+            return await conn.fetchval("""
                 SELECT response_id
                 FROM agent.api_history
                 WHERE thread_id = $1 AND expires_at > NOW()
                 ORDER BY created_at DESC
                 LIMIT 1
             """, thread_id)
-            return row['response_id'] if row else None
+    
+    async def prune_expired_api_history(self) -> int:
+        """Delete expired API history entries and return how many were removed"""
+        async with self.acquire() as conn:
+            result = await conn.execute("""
+                DELETE FROM agent.api_history WHERE expires_at <= NOW()
+            """)
+        
+        return int(result.split()[-1])
     
     async def get_api_history(self, thread_id: str) -> List[Dict[str, Any]]:
         """Get all API history entries for a thread"""
@@ -191,44 +331,85 @@ class DatabaseManager:
     async def add_text_history_entry(self, thread_id: str, user_input: str, assistant_response: str) -> None:
         """Add a text history entry"""
         async with self.acquire() as conn:
-            # Get the next sequence number
-            row = await conn.fetchrow("""
-                SELECT COALESCE(MAX(sequence_number), 0) + 1 as next_seq
-                FROM agent.text_history
-                WHERE thread_id = $1
-            """, thread_id)
-            next_seq = row['next_seq']
-            
-            await conn.execute("""
-                INSERT INTO agent.text_history (thread_id, user_input, assistant_response, sequence_number)
-                VALUES ($1, $2, $3, $4)
-            """, thread_id, user_input, assistant_response, next_seq)
-            
-            # Update thread last_activity
-            await conn.execute("""
+            # Insert and bump thread last_activity in one round-trip; sequence_number comes from
+            # a global sequence, which is still monotonic within each thread
+            user_id = await conn.fetchval("""
+                WITH inserted AS (
+                    INSERT INTO agent.text_history (thread_id, user_input, assistant_response)
+                    VALUES ($1, $2, $3)
+                )
                 UPDATE agent.threads SET last_activity = NOW() WHERE id = $1
-            """, thread_id)
+                RETURNING user_id
+            """, thread_id, user_input, assistant_response)
+        
+        self._invalidate_user_threads(user_id)
+    
+    async def add_text_history_entries(self, thread_id: str, turns: List[Tuple[str, str]]) -> None:
+        """Add several (user_input, assistant_response) text history entries in one batch"""
+        if not turns:
+            return
+        async with self.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany("""
+                    INSERT INTO agent.text_history (thread_id, user_input, assistant_response)
+                    VALUES ($1, $2, $3)
+                """, [(thread_id, user_input, assistant_response) for user_input, assistant_response in turns])
+                
+                user_id = await conn.fetchval("""
+                    UPDATE agent.threads SET last_activity = NOW() WHERE id = $1
+                    RETURNING user_id
+                """, thread_id)
+        
+        self._invalidate_user_threads(user_id)
     
     async def get_text_history(self, thread_id: str) -> str:
         """Get formatted text history for a thread"""
+        cached = self._text_history_cache.get(thread_id)
         async with self.acquire() as conn:
+            if cached is not None:
+                cached_count, cached_seq, cached_text = cached
+                # Index-only probe on idx_text_history_thread_seq tells whether the cached text is current
+                count, max_seq = await conn.fetchrow("""
+                    SELECT count(*), max(sequence_number)
+                    FROM agent.text_history
+                    WHERE thread_id = $1
+                """, thread_id)
+                if (count, max_seq) == (cached_count, cached_seq):
+                    self._text_history_cache.move_to_end(thread_id)
+                    return cached_text
+                
+                if cached_count and count > cached_count:
+                    # New turns were appended (by any worker); fetch only those
+                    rows = await conn.fetch("""
+                        SELECT sequence_number, user_input, assistant_response
+                        FROM agent.text_history
+                        WHERE thread_id = $1 AND sequence_number > $2
+                        ORDER BY sequence_number
+                    """, thread_id, cached_seq)
+                    # Fewer rows than expected means one landed below cached_seq; rebuild fully
+                    if rows and cached_count + len(rows) >= count:
+                        new_text = "\n".join([format_text_turn(row['user_input'], row['assistant_response']) for row in rows])
+                        history = f"{cached_text}\n{new_text}"
+                        self._store_text_history(thread_id, cached_count + len(rows), rows[-1]['sequence_number'], history)
+                        return history
+            
             rows = await conn.fetch("""
-                SELECT user_input, assistant_response
+                SELECT sequence_number, user_input, assistant_response
                 FROM agent.text_history
                 WHERE thread_id = $1
                 ORDER BY sequence_number
             """, thread_id)
-            
-            if not rows:
-                return ""
-            
-            history_parts = []
-            for row in rows:
-                history_parts.append(f"User: {row['user_input']}")
-                history_parts.append(f"Assistant: {row['assistant_response']}")
-                history_parts.append("")
-            
-            return "\n".join(history_parts)
+        
+        # Each turn is "User: ...\nAssistant: ...\n" with a blank line between turns
+        history = "\n".join([format_text_turn(row['user_input'], row['assistant_response']) for row in rows])
+        self._store_text_history(thread_id, len(rows), rows[-1]['sequence_number'] if rows else None, history)
+        return history
+    
+    def _store_text_history(self, thread_id: str, count: int, max_seq: Optional[int], history: str) -> None:
+        self._text_history_cache[thread_id] = (count, max_seq, history)
+        self._text_history_cache.move_to_end(thread_id)
+        if len(self._text_history_cache) > TEXT_HISTORY_CACHE_SIZE:
+            self._text_history_cache.popitem(last=False)
 
 # Global database manager instance
 db_manager = DatabaseManager()
@@ -3,6 +3,7 @@
 Initialize database for Chainlit with Prisma schema
 """
 import asyncio
+import hashlib
 import subprocess
 import os
 import time
@@ -10,6 +11,28 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+SCHEMA_PATH = "schema.prisma"
+# Records the schema/database that was last pushed so container restarts can skip `prisma db push`
+MARKER_PATH = os.getenv("PRISMA_INIT_MARKER", "/tmp/.prisma_init")
+
+def schema_fingerprint():
+    """Hash the Prisma schema together with the target database URL"""
+    digest = hashlib.sha256()
+    with open(SCHEMA_PATH, "rb") as f:
+        digest.update(f.read())
+    digest.update(os.getenv("DATABASE_URL", "").encode())
+    return digest.hexdigest()
+
+async def prisma_tables_exist():
+    """Check the database itself for a Prisma-managed table, so a recreated database is never skipped"""
+    import asyncpg
+    
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    try:
+        return await conn.fetchval("""SELECT to_regclass('"Thread"') IS NOT NULL""")
+    finally:
+        await conn.close()
+
 async def wait_for_postgres(max_attempts=30):
     """Wait for PostgreSQL to be ready"""
     database_url = os.getenv("DATABASE_URL")
@@ -32,13 +55,21 @@ async def wait_for_postgres(max_attempts=30):
     
     raise Exception("PostgreSQL did not become ready in time")
 
-def run_prisma_migrate():
+async def run_prisma_migrate():
     """Run Prisma migrations to set up database schema"""
     print("🔧 [CHAINLIT-DB] Setting up Prisma database schema...")
     
     # Check if Prisma client is already generated (from build time)
     print("✓ [CHAINLIT-DB] Prisma client already generated during build")
     
+    fingerprint = schema_fingerprint()
+    if os.path.exists(MARKER_PATH):
+        with open(MARKER_PATH) as f:
+            marker_matches = f.read().strip() == fingerprint
+        if marker_matches and await prisma_tables_exist():
+            print("✓ [CHAINLIT-DB] Schema unchanged since last push, skipping prisma db push")
+            return True
+    
     # Only run schema push (lightweight operation)
     result = subprocess.run(
         ["python", "-m", "prisma", "db", "push"],
@@ -50,6 +81,13 @@ def run_prisma_migrate():
         print(f"❌ [CHAINLIT-DB] Prisma db push failed: {result.stderr}")
         return False
     
+    if not await prisma_tables_exist():
+        print("❌ [CHAINLIT-DB] Prisma db push did not create the Chainlit tables")
+        return False
+    
+    with open(MARKER_PATH, "w") as f:
+        f.write(fingerprint)
+    
     print("✅ [CHAINLIT-DB] Database schema created successfully!")
     return True
 
@@ -64,7 +102,7 @@ async def main():
         print("✅ [CHAINLIT-DB] PostgreSQL connection successful")
         
         print("🔧 [CHAINLIT-DB] Setting up Chainlit database schema...")
-        if run_prisma_migrate():
+        if await run_prisma_migrate():
             print("✅ [CHAINLIT-DB] Chainlit schema created successfully")
             print("🎉 [CHAINLIT-DB] Database initialization complete!")
         else:
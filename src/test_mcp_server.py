@@ -30,8 +30,8 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- Simple In-Memory Event Store (from example, for resumability if needed) ---
-from collections import deque
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from itertools import count
 from uuid import uuid4
 
 @dataclass
@@ -39,26 +39,42 @@ class EventEntry:
     event_id: EventId
     stream_id: StreamId
     message: JSONRPCMessage
+    position: int  # Monotonic position within its stream, used to jump straight to it on replay
+
+@dataclass
+class StreamLog:
+    events: list[EventEntry] = field(default_factory=list)
+    head: int = 0  # Index of the oldest retained event; entries before it have been evicted
+    base: int = 0  # Position of events[0], so an event sits at events[position - base]
 
 class InMemoryEventStore(EventStore):
     def __init__(self, max_events_per_stream: int = 100):
         self.max_events_per_stream = max_events_per_stream
-        self.streams: dict[StreamId, deque[EventEntry]] = {}
+        self.streams: dict[StreamId, StreamLog] = {}
         self.event_index: dict[EventId, EventEntry] = {}
+        # Ids only need to be unique within this store; the instance prefix keeps them distinct across restarts
+        self._instance_id = uuid4().hex
+        self._event_counter = count()
 
     async def store_event(
         self, stream_id: StreamId, message: JSONRPCMessage
     ) -> EventId:
-        event_id = str(uuid4())
+        event_id = f"{self._instance_id}-{next(self._event_counter)}"
+        if stream_id not in self.streams:
+            self.streams[stream_id] = StreamLog()
+        log = self.streams[stream_id]
         event_entry = EventEntry(
-            event_id=event_id, stream_id=stream_id, message=message
+            event_id=event_id, stream_id=stream_id, message=message, position=log.base + len(log.events)
         )
-        if stream_id not in self.streams:
-            self.streams[stream_id] = deque(maxlen=self.max_events_per_stream)
-        if len(self.streams[stream_id]) == self.max_events_per_stream:
-            oldest_event = self.streams[stream_id][0]
-            self.event_index.pop(oldest_event.event_id, None)
-        self.streams[stream_id].append(event_entry)
+        if len(log.events) - log.head == self.max_events_per_stream:
+            # Evict by advancing the head; the list is only compacted once the dead prefix is as long as the window
+            self.event_index.pop(log.events[log.head].event_id, None)
+            log.head += 1
+            if log.head >= self.max_events_per_stream:
+                del log.events[:log.head]
+                log.base += log.head
+                log.head = 0
+        log.events.append(event_entry)
         self.event_index[event_id] = event_entry
         return event_id
 
@@ -72,51 +88,51 @@ class InMemoryEventStore(EventStore):
             return None
         last_event = self.event_index[last_event_id]
         stream_id = last_event.stream_id
-        stream_events = self.streams.get(last_event.stream_id, deque())
-        found_last = False
-        for event in stream_events:
-            if found_last:
-                await send_callback(EventMessage(event.message, event.event_id))
-            elif event.event_id == last_event_id:
-                found_last = True
+        log = self.streams[stream_id]
+        # Indexed events are always still retained, so the slice starts at a live entry
+        for event in log.events[last_event.position - log.base + 1:]:
+            await send_callback(EventMessage(event.message, event.event_id))
         return stream_id
 
 # --- MCP Application Setup ---
 mcp_app = LowLevelMCPAPIServer("MyLowLevelTestServer")
 
+# Tool definitions are static, so they are built once and returned as-is on every tools/list
+TOOLS: list[types.Tool] = [
+    types.Tool(
+        name="echo",
+        description="Echoes the input message back to the caller.",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "message": {"type": "string", "description": "The message to echo."}
+            },
+            "required": ["message"],
+        },
+    ),
+    types.Tool(
+        name="add",
+        description="Adds two integers and returns the result.",
+        inputSchema={
+            "type": "object",
+            "properties": {
+                "a": {"type": "integer", "description": "The first number."},
+                "b": {"type": "integer", "description": "The second number."},
+            },
+            "required": ["a", "b"],
+        },
+    ),
+    types.Tool(
+        name="get_server_time",
+        description="Returns the current server time as an ISO 8601 string.",
+        inputSchema={"type": "object", "properties": {}}, # No input properties
+    ),
+]
+
 @mcp_app.list_tools()
 async def list_tools() -> list[types.Tool]:
     logger.info("list_tools called")
-    return [
-        types.Tool(
-            name="echo",
-            description="Echoes the input message back to the caller.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "message": {"type": "string", "description": "The message to echo."}
-                },
-                "required": ["message"],
-            },
-        ),
-        types.Tool(
-            name="add",
-            description="Adds two integers and returns the result.",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "a": {"type": "integer", "description": "The first number."},
-                    "b": {"type": "integer", "description": "The second number."},
-                },
-                "required": ["a", "b"],
-            },
-        ),
-        types.Tool(
-            name="get_server_time",
-            description="Returns the current server time as an ISO 8601 string.",
-            inputSchema={"type": "object", "properties": {}}, # No input properties
-        ),
-    ]
+    return TOOLS
 
 @mcp_app.call_tool()
 async def call_tool(
@@ -216,6 +232,7 @@ starlette_app.add_middleware(
 
 if __name__ == "__main__":
     logger.info(f"Starting server on {SERVER_HOST}:{SERVER_PORT}")
+    # loop/http default to "auto": uvloop and httptools from uvicorn[standard] are used when installed
     uvicorn.run(
         starlette_app,
         host=SERVER_HOST,